@@ -18,7 +18,8 @@
 
 from argparse import ArgumentParser
 from uuid import UUID, uuid4, uuid5
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
 import logging
 import os
@@ -27,13 +28,26 @@ import subprocess
 import shutil
 import sys
 import hashlib
+import ntpath
+import posixpath
+import threading
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '3rdparty', 'ico2dll'))
 
 from ico2dll import ico2dll
 
+# ids are derived from md5('parentid|name'), the hash of the 'parentid|' part
+# can be computed once and reused for all children of a directory
+def idhash(parentid):
+    return hashlib.md5('{}|'.format(parentid).encode('utf-16le'))
+
+def makeidfromhash(prefix, parenthash, name):
+    h = parenthash.copy()
+    h.update(name.encode('utf-16le'))
+    return prefix + h.hexdigest().upper()
+
 def makeid(prefix, parentid, name):
-    return prefix + hashlib.md5('{}|{}'.format(parentid, name).encode('utf-16le')).hexdigest().upper()
+    return makeidfromhash(prefix, idhash(parentid), name)
 
 ap = ArgumentParser()
 ap.add_argument('--output-msi', '-o', metavar='PATH/TO/OUT.MSI')
@@ -142,17 +156,90 @@ def addregcomp(*, Root='HKLM', Key, Name='', Value, Type='string'):
 
     return c
 
-# recursive file component helper
-def walkdir(direl, sourcepath):
-    for e in os.scandir(sourcepath):
-        if e.is_dir():
-            d = ET.SubElement(direl, 'Directory', Name=e.name, Id=makeid('dir', direl.attrib['Id'], e.name))
-            walkdir(d, e.path)
-        else:
-            fileid = makeid('fil', direl.attrib['Id'], e.name)
-            compid = makeid('cmp', direl.attrib['Id'], fileid)
-            comp = ET.SubElement(direl, 'Component', Guid='*', Feature=feature.attrib['Id'], Id=compid)
-            f = ET.SubElement(comp, 'File', Name=e.name, DiskId='1', Source=e.path, KeyPath='yes', Id=fileid)
+# write an element tree as .wxs file, streaming it out instead of building the whole document in memory
+# (ElementTree emits lots of tiny writes, so use a generous buffer)
+def writewxs(root, path):
+    with open(path, 'wb', buffering=1<<20) as f:
+        ET.ElementTree(root).write(f, encoding='utf-8', xml_declaration=True)
+
+# file component helper, walks the source directory using an explicit stack
+def walkdir(rootel, rootpath):
+    featureid = feature.attrib['Id']
+    stack = [(rootel, rootpath)]
+
+    while stack:
+        direl, sourcepath = stack.pop()
+
+        # sort entries so the generated .wxs doesn't depend on directory order
+        with os.scandir(sourcepath) as it:
+            entries = sorted(it, key=lambda e: e.name)
+
+        parenthash = idhash(direl.attrib['Id'])
+
+        for e in entries:
+            # attributes are passed as dicts here, this is the hot loop and
+            # SubElement() would otherwise have to merge the keyword arguments
+            if e.is_dir():
+                d = ET.SubElement(direl, 'Directory', {'Name': e.name, 'Id': makeidfromhash('dir', parenthash, e.name)})
+                stack.append((d, e.path))
+            else:
+                fileid = makeidfromhash('fil', parenthash, e.name)
+                compid = makeidfromhash('cmp', parenthash, fileid)
+                comp = ET.SubElement(direl, 'Component', {'Guid': '*', 'Feature': featureid, 'Id': compid})
+                f = ET.SubElement(comp, 'File', {'Name': e.name, 'DiskId': '1', 'Source': e.path, 'KeyPath': 'yes', 'Id': fileid})
+
+# key identifying the file a zip member is extracted to: drop drive letters,
+# empty, '.' and '..' parts like zipfile does, and fold case, illegal characters and
+# trailing dots/spaces like Windows does. This folds a bit more than necessary on
+# other platforms, which only means some members end up in the same group below.
+def zipmemberkey(name):
+    name = ntpath.splitdrive(name.replace('\\', '/'))[1]
+    parts = [p.translate(ZIP_ILLEGAL_CHARS).rstrip(' .').upper() for p in name.split('/')]
+    return '/'.join(p for p in parts if p)
+
+ZIP_ILLEGAL_CHARS = str.maketrans(':<>|"?*', '_______')
+
+# extract a zip file using a thread pool; zlib releases the GIL while inflating,
+# so members can be decompressed in parallel
+def extractzip(zippath, destdir):
+    # members that end up in the same file (duplicate or aliased names) are extracted
+    # by the same worker in archive order, so the last one wins like with extractall()
+    groups = {}
+    with ZipFile(zippath, 'r') as z:
+        # create destdir and all directories below it up front,
+        # the workers would race on them otherwise
+        os.makedirs(destdir, exist_ok=True)
+
+        dirs = set()
+        for info in z.infolist():
+            if info.is_dir():
+                dirs.add(info.filename)
+            else:
+                groups.setdefault(zipmemberkey(info.filename), []).append(info)
+                parent = posixpath.dirname(info.filename)
+                if parent:
+                    dirs.add(parent + '/')
+
+        for d in sorted(dirs):
+            z.extract(ZipInfo(d), destdir)
+
+    # ZipFile objects must not be shared between threads, give each worker its own
+    local = threading.local()
+    opened = []
+
+    def extractgroup(members):
+        if not hasattr(local, 'zipfile'):
+            local.zipfile = ZipFile(zippath, 'r')
+            opened.append(local.zipfile)
+        for info in members:
+            local.zipfile.extract(info, destdir)
+
+    try:
+        with ThreadPoolExecutor() as ex:
+            list(ex.map(extractgroup, groups.values()))
+    finally:
+        for z in opened:
+            z.close()
 
 def findfileelforpath(direl, path):
     path = path.replace('\\', '/')
@@ -160,18 +247,20 @@ def findfileelforpath(direl, path):
     i = path.find('/')
     if i < 0:
         # last part, search file component
+        name = path.upper()
         for subel in direl:
             if subel.tag == 'Component':
                 for subsubel in subel:
-                    if subsubel.tag == 'File' and subsubel.attrib['Name'].upper() == path.upper():
+                    if subsubel.tag == 'File' and subsubel.attrib['Name'].upper() == name:
                         return subsubel
     else:
         # directory part
+        name = path[0:i].upper()
         for subel in direl:
             if subel.tag != 'Directory':
                 continue
 
-            if subel.attrib['Name'].upper() == path[0:i].upper():
+            if subel.attrib['Name'].upper() == name:
                 return findfileelforpath(subel, path[i+1:])
 
     return None
@@ -180,10 +269,9 @@ with tempfile.TemporaryDirectory() as tmpdir:
     if os.path.isdir(args.sourcedirectory):
         walkdir(installdir, args.sourcedirectory)
     else:
-        with ZipFile(args.sourcedirectory, 'r') as z:
-            s = os.path.join(tmpdir, 'src')
-            z.extractall(s)
-            walkdir(installdir, s)
+        s = os.path.join(tmpdir, 'src')
+        extractzip(args.sourcedirectory, s)
+        walkdir(installdir, s)
 
     shortcutel = None
     if args.shortcut is not None:
@@ -229,32 +317,36 @@ with tempfile.TemporaryDirectory() as tmpdir:
     # file associations
     if len(args.assoc_extension) > 0 and args.assoc_target is not None:
         targetpath = '"[INSTALLDIR]{}"'.format(args.assoc_target.replace('/', '\\'))
+        opencommand = '{} "%1"'.format(targetpath)
+        appkey = 'Software\\Classes\\Applications\\{}.exe'.format(args.upgrade_code)
+        capabilitieskey = appkey + '\\Capabilities'
 
         addregcomp(Key='Software\\RegisteredApplications',
                     Name='{}'.format(args.upgrade_code),
-                    Value='Software\\Classes\\Applications\\{}.exe\\Capabilities'.format(args.upgrade_code))
+                    Value=capabilitieskey)
 
-        addregcomp(Key='Software\\Classes\\Applications\\{}.exe\\Capabilities'.format(args.upgrade_code),
+        addregcomp(Key=capabilitieskey,
                     Name='ApplicationDescription',
                     Value=args.name)
 
-        addregcomp(Key='Software\\Classes\\Applications\\{}.exe\\shell\\open\\command'.format(args.upgrade_code),
-                    Value='{} "%1"'.format(targetpath))
+        addregcomp(Key=appkey + '\\shell\\open\\command',
+                    Value=opencommand)
 
         for ext in args.assoc_extension:
             progid = '{}.Assoc.{}'.format(args.upgrade_code, ext)
+            progidkey = 'Software\\Classes\\' + progid
 
-            addregcomp(Key='Software\\Classes\\{}\\DefaultIcon'.format(progid),
+            addregcomp(Key=progidkey + '\\DefaultIcon',
                         Value='{},{}'.format(targetpath, args.assoc_icon_index))
 
             if args.assoc_description is not None:
-                addregcomp(Key='Software\\Classes\\{}'.format(progid),
+                addregcomp(Key=progidkey,
                            Value=args.assoc_description)
 
-            addregcomp(Key='Software\\Classes\\{}\\shell\\open\\command'.format(progid),
-                        Value='{} "%1"'.format(targetpath))
+            addregcomp(Key=progidkey + '\\shell\\open\\command',
+                        Value=opencommand)
 
-            addregcomp(Key='Software\\Classes\\Applications\\{}.exe\\Capabilities\\FileAssociations'.format(args.upgrade_code),
+            addregcomp(Key=capabilitieskey + '\\FileAssociations',
                         Name='.{}'.format(ext),
                         Value=progid)
 
@@ -273,9 +365,7 @@ with tempfile.TemporaryDirectory() as tmpdir:
         ET.SubElement(iesel, 'Custom', Action=cael.attrib['Id'], After='InstallFinalize')
 
     # write wxs and build msi
-    with open(os.path.join(tmpdir, 'app.wxs'), 'wb') as f:
-        f.write(b'<?xml version="1.0" encoding="utf-8" ?>')
-        f.write(ET.tostring(wix))
+    writewxs(wix, os.path.join(tmpdir, 'app.wxs'))
 
     if args.output_wxs is not None:
         shutil.copyfile(os.path.join(tmpdir, 'app.wxs'), args.output_wxs)
@@ -299,17 +389,17 @@ with tempfile.TemporaryDirectory() as tmpdir:
 
     subprocess.run([lightexe] + lightargs + ['-out', os.path.join(tmpdir, basename + '.msi'), os.path.join(tmpdir, 'app.wixobj')], check=True)
 
-    try:
-        subprocess.run([smokeexe, '-nologo', '-sice:ICE61', '-sice:ICE40', os.path.join(tmpdir, basename + '.msi')], check=True)
-    except subprocess.CalledProcessError as e:
-        logging.warning('MSI validation failed')
-        logging.warning(e)
+    # validation only reads the msi, so copy it to the output while smoke is running
+    with subprocess.Popen([smokeexe, '-nologo', '-sice:ICE61', '-sice:ICE40', os.path.join(tmpdir, basename + '.msi')]) as smoke:
+        if args.output_msi is not None:
+            shutil.copyfile(os.path.join(tmpdir, basename+'.msi'), args.output_msi)
 
-    if args.output_msi is not None:
-        shutil.copyfile(os.path.join(tmpdir, basename+'.msi'), args.output_msi)
+            if args.cabfile is not None:
+                shutil.copyfile(os.path.join(tmpdir, args.cabfile), os.path.join(os.path.dirname(args.output_msi), args.cabfile))
 
-        if args.cabfile is not None:
-            shutil.copyfile(os.path.join(tmpdir, args.cabfile), os.path.join(os.path.dirname(args.output_msi), args.cabfile))
+    if smoke.returncode != 0:
+        logging.warning('MSI validation failed')
+        logging.warning('smoke exited with status {}'.format(smoke.returncode))
 
     if args.output_exe is not None:
         bundlewix = ET.Element('Wix', xmlns='http://schemas.microsoft.com/wix/2006/wi')
@@ -326,9 +416,7 @@ with tempfile.TemporaryDirectory() as tmpdir:
         chain = ET.SubElement(bundle, 'Chain')
         mp = ET.SubElement(chain, 'MsiPackage', Id='Main', SourceFile=basename+'.msi', Vital='yes', Cache='yes')
 
-        with open(os.path.join(tmpdir, 'bundle.wxs'), 'wb') as f:
-            f.write(b'<?xml version="1.0" encoding="utf-8" ?>')
-            f.write(ET.tostring(bundlewix))
+        writewxs(bundlewix, os.path.join(tmpdir, 'bundle.wxs'))
 
         subprocess.run([candleexe, '-nologo', '-arch', arch, '-ext', 'WixBalExtension',
                         '-out', os.path.join(tmpdir, 'bundle.wixobj'), os.path.join(tmpdir, 'bundle.wxs')], check=True)